@@ -1,10 +1,19 @@
 import json
 import os
+from collections import defaultdict
 import uuid
 import argparse
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 def load_json_data(json_file_path):
     """Load and return JSON data from the specified file."""
+    if orjson is not None:
+        with open(json_file_path, 'rb') as f:
+            return orjson.loads(f.read())
     with open(json_file_path, 'r') as f:
         return json.load(f)
 
@@ -24,45 +33,60 @@ def map_type_encoding(json_type):
     }
     return type_mapping.get(json_type)
 
+def read_blob_value(blob_value):
+    """Return the bytes of a BLOB chunk stored as hex or as a {"file": path} reference."""
+    if isinstance(blob_value, dict):
+        with open(blob_value['file'], 'rb') as f:
+            return f.read()
+    return bytes.fromhex(blob_value)
+
 def write_blob_file(blob_values, output_dir):
     """Write concatenated BLOB data to a file and return the file path."""
+    # A BLOB held in a single chunk file can be used as is
+    if len(blob_values) == 1 and isinstance(blob_values[0], dict):
+        return blob_values[0]['file']
     blob_filename = f"blob_{uuid.uuid4().hex}.bin"
     blob_path = os.path.join(output_dir, blob_filename)
     with open(blob_path, 'wb') as f:
-        for blob_value in blob_values:
-            f.write(bytes.fromhex(blob_value))
+        if all(isinstance(blob_value, str) for blob_value in blob_values):
+            f.write(bytes.fromhex(''.join(blob_values)))
+        else:
+            for blob_value in blob_values:
+                f.write(read_blob_value(blob_value))
     return blob_path
 
 def generate_csv(json_data, csv_output_path, blobs_output_dir):
     """Generate CSV file and BLOB files from JSON data."""
     os.makedirs(blobs_output_dir, exist_ok=True)
-    csv_lines = ["key,type,encoding,value"]
+    # Rows are encoded as they are written, straight into a large binary buffer
+    with open(csv_output_path, 'wb', buffering=1 << 20) as out:
+        out.write(b"key,type,encoding,value\n")
+        write_csv_entries(json_data, out, blobs_output_dir)
 
+def write_csv_entries(json_data, out, blobs_output_dir):
+    """Write the CSV rows for all namespaces to an open binary file."""
     # Group entries by namespace
     namespace_map = json_data['namespaces']
     entries = json_data['entries']
-    entries_by_namespace = {}
+    entries_by_namespace = defaultdict(list)
     for entry in entries:
-        ns_name = entry['namespace']
-        if ns_name not in entries_by_namespace:
-            entries_by_namespace[ns_name] = []
-        entries_by_namespace[ns_name].append(entry)
+        entries_by_namespace[entry['namespace']].append(entry)
 
-    # Write CSV entries, ensuring namespace entries come first
-    for ns_id, ns_name in sorted(namespace_map.items(), key=lambda x: int(x[0])):
+    # Write CSV entries in namespace id order (JSON object keys are strings)
+    ns_items = [(int(ns_id), ns_name) for ns_id, ns_name in namespace_map.items()]
+    ns_items.sort()
+    for ns_id, ns_name in ns_items:
         # Add namespace entry
-        csv_lines.append(f"{ns_name},namespace,,")
+        out.write(f"{ns_name},namespace,,\n".encode('utf-8'))
         
         # Group BLOB_DATA entries by key for this namespace
-        blob_data_by_key = {}
+        blob_data_by_key = defaultdict(list)
         non_blob_entries = []
         for entry in entries_by_namespace.get(ns_name, []):
             key = entry['key']
             entry_type = entry['type']
             
             if entry_type == 'BLOB_DATA':
-                if key not in blob_data_by_key:
-                    blob_data_by_key[key] = []
                 blob_data_by_key[key].append((entry['chunk_index'], entry['value']))
             elif entry_type != 'BLOB_IDX':  # Skip BLOB_IDX entries
                 non_blob_entries.append(entry)
@@ -75,7 +99,7 @@ def generate_csv(json_data, csv_output_path, blobs_output_dir):
             blob_values = [value for _, value in blob_entries]
             # Write concatenated BLOB data to file
             blob_path = write_blob_file(blob_values, blobs_output_dir)
-            csv_lines.append(f"{key},file,binary,{blob_path}")
+            out.write(f"{key},file,binary,{blob_path}\n".encode('utf-8'))
 
         # Process non-BLOB entries
         for entry in non_blob_entries:
@@ -83,17 +107,19 @@ def generate_csv(json_data, csv_output_path, blobs_output_dir):
             entry_type = entry['type']
             encoding = map_type_encoding(entry_type)
             value = entry['value']
+
+            # Legacy single-chunk BLOBs are written out like BLOB_DATA
+            if entry_type == 'BLOB':
+                blob_path = write_blob_file([value], blobs_output_dir)
+                out.write(f"{key},file,binary,{blob_path}\n".encode('utf-8'))
+                continue
             
             # Handle non-BLOB data
             if isinstance(value, dict):
                 value_str = json.dumps(value)
             else:
                 value_str = str(value)
-            csv_lines.append(f"{key},data,{encoding},{value_str}")
-
-    # Write CSV file
-    with open(csv_output_path, 'w', newline='') as f:
-        f.write('\n'.join(csv_lines))
+            out.write(f"{key},data,{encoding},{value_str}\n".encode('utf-8'))
 
 def main():
     # Set up command-line argument parsing
@@ -1,7 +1,17 @@
 import argparse
 import json
+import mmap
 import os
+import re
 import struct
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 nvs_types = {
     0x01: "U8", 0x11: "I8", 0x02: "U16", 0x12: "I16",
@@ -18,158 +28,258 @@ nvs_sector_states = {
     0xFFFFFFF0: "CORRUPT"
 }
 
+# Only ACTIVE and FULL pages hold entries worth decoding
+nvs_readable_states = frozenset(raw for raw, state in nvs_sector_states.items() if state in ("ACTIVE", "FULL"))
+
 entry_state_descs = {
     3: "Empty",
     2: "Written",
     0: "Erased"
 }
 
-def parse_nvs_entries(entries, entry_state_bitmap, namespaces, page_num):
+# 2-bit entry states packed four per bitmap byte, first entry in the high bits
+entry_state_table = [bytes((byte >> shift) & 3 for shift in (6, 4, 2, 0)) for byte in range(256)]
+
+# ns, type, span, chunk_index; crc32, key and data are read in place
+nvs_entry_layout = struct.Struct("<BBBB28x")
+
+# Layouts of the 8-byte data field, unpacked at offset 24 of an entry
+nvs_scalar_layouts = {
+    0x01: struct.Struct("<B"), 0x11: struct.Struct("<b"),
+    0x02: struct.Struct("<H"), 0x12: struct.Struct("<h"),
+    0x04: struct.Struct("<I"), 0x14: struct.Struct("<i"),
+    0x08: struct.Struct("<Q"), 0x18: struct.Struct("<q")
+}
+varlen_size_layout = struct.Struct("<H")  # STR/BLOB/BLOB_DATA: size, rsv, crc32
+blob_idx_layout = struct.Struct("<IxBB")  # size, rsv, chunk_count, chunk_start
+
+# Entry decoders fill in entry_data["value"] and return False to drop the entry
+
+def scalar_decoder(layout):
+    def decode_scalar(entries, i, entry_span, entry_data):
+        entry_data["value"], = layout.unpack_from(entries, i * 32 + 24)
+        return True
+    return decode_scalar
+
+def read_varlen_data(entries, i, entry_span):
+    size, = varlen_size_layout.unpack_from(entries, i * 32 + 24)
+    if size < 0 or size > 4032:  # Max size within 4KB page minus header
+        return None
+    # The data fills the entries following the header entry, which are contiguous in the page
+    data_start = (i + 1) * 32
+    data = entries[data_start:min(data_start + size, (i + entry_span) * 32)]
+    # A truncated dump can end inside the span; drop the entry rather than emit partial data
+    if len(data) < min(size, (entry_span - 1) * 32):
+        return None
+    return data, size
+
+def decode_str(entries, i, entry_span, entry_data):
+    varlen = read_varlen_data(entries, i, entry_span)
+    if varlen is None:
+        return False
+    entry_data["value"] = varlen[0].decode('ascii', errors='ignore')
+    entry_data["size"] = varlen[1]
+    return True
+
+def decode_blob(entries, i, entry_span, entry_data):
+    varlen = read_varlen_data(entries, i, entry_span)
+    if varlen is None:
+        return False
+    entry_data["value"] = varlen[0]  # Raw bytes, see store_blob_value
+    entry_data["size"] = varlen[1]
+    return True
+
+def decode_blob_idx(entries, i, entry_span, entry_data):
+    size, chunk_count, chunk_start = blob_idx_layout.unpack_from(entries, i * 32 + 24)
+    entry_data["value"] = {"size": size, "chunk_count": chunk_count, "chunk_start": chunk_start}
+    return True
+
+# ANY (0xFF) has no decoder and is skipped like an unknown type
+nvs_entry_decoders = {entry_type: scalar_decoder(layout) for entry_type, layout in nvs_scalar_layouts.items()}
+nvs_entry_decoders.update({0x21: decode_str, 0x41: decode_blob, 0x42: decode_blob, 0x48: decode_blob_idx})
+
+nvs_blob_types = frozenset((0x41, 0x42))  # BLOB, BLOB_DATA
+
+# BLOB data goes into the JSON as hex, or into its own file under blob_dir. The page number and
+# entry index make the file name unique; the key is only appended to make it readable.
+def store_blob_value(entry_data, blob_dir, page_num, entry_index):
+    if blob_dir is None:
+        return entry_data["value"].hex()
+    key = re.sub(r'[^\w.-]', '_', entry_data['key'])
+    blob_path = os.path.join(blob_dir, f"p{page_num}_e{entry_index}_{key}.bin")
+    with open(blob_path, 'wb') as f:
+        f.write(entry_data["value"])
+    return {"file": blob_path}
+
+# Decodes the Written entries of one page. Namespace names and BLOB storage are left to
+# resolve_nvs_entries so that pages can be decoded independently, in any process.
+def parse_nvs_entries(entries, entry_states):
+    # Decode every entry header of the page in a single pass
+    headers = list(nvs_entry_layout.iter_unpack(entries))
     result = []
     i = 0
-    while i < 126:
-        try:
-            state = int(entry_state_bitmap[i])
-            if state != 2:  # Only process Written entries
-                i += 1
-                continue
-
-            entry = entries[i]
-            entry_ns = entry[0]
-            entry_type = entry[1]
-            entry_span = entry[2]
-            chunk_index = entry[3]
-            key = entry[8:24].rstrip(b'\x00')
-            data = entry[24:]
-
-            if entry_type not in nvs_types:
-                i += 1
-                continue
-            if entry_span < 1 or entry_span > 126 - i:
-                i += 1
-                continue
-
-            entry_data = {
-                "key": key.decode('ascii', errors='ignore'),
-                "type": nvs_types[entry_type],
-                "namespace": namespaces.get(entry_ns, f"NS_{entry_ns}"),
-                "span": entry_span,
-                "chunk_index": chunk_index
-            }
-
-            if nvs_types[entry_type] == "U8":
-                value = struct.unpack("<B", data[0:1])[0]
-                entry_data["value"] = value
-                if entry_ns == 0:
-                    namespaces[value] = entry_data["key"]
-            elif nvs_types[entry_type] == "I8":
-                entry_data["value"] = struct.unpack("<b", data[0:1])[0]
-            elif nvs_types[entry_type] == "U16":
-                entry_data["value"] = struct.unpack("<H", data[0:2])[0]
-            elif nvs_types[entry_type] == "I16":
-                entry_data["value"] = struct.unpack("<h", data[0:2])[0]
-            elif nvs_types[entry_type] == "U32":
-                entry_data["value"] = struct.unpack("<I", data[0:4])[0]
-            elif nvs_types[entry_type] == "I32":
-                entry_data["value"] = struct.unpack("<i", data[0:4])[0]
-            elif nvs_types[entry_type] == "U64":
-                entry_data["value"] = struct.unpack("<Q", data[0:8])[0]
-            elif nvs_types[entry_type] == "I64":
-                entry_data["value"] = struct.unpack("<q", data[0:8])[0]
-            elif nvs_types[entry_type] in ["STR", "BLOB", "BLOB_DATA"]:
-                size = struct.unpack("<H", data[0:2])[0]
-                if size < 0 or size > 4032:  # Max size within 4KB page minus header
-                    i += entry_span
-                    continue
-                data_chunks = [data[8:]]
-                for x in range(1, entry_span):
-                    if i + x >= 126:
-                        break
-                    data_chunks.append(entries[i + x])
-                combined_data = b''.join(data_chunks)[:size]
-                entry_data["value"] = (combined_data.decode('ascii', errors='ignore') if nvs_types[entry_type] == "STR"
-                                      else combined_data.hex())
-                entry_data["size"] = size
-            elif nvs_types[entry_type] == "BLOB_IDX":
-                size = struct.unpack("<I", data[0:4])[0]
-                chunk_count = struct.unpack("<B", data[5:6])[0]
-                chunk_start = struct.unpack("<B", data[6:7])[0]
-                entry_data["value"] = {"size": size, "chunk_count": chunk_count, "chunk_start": chunk_start}
-            elif nvs_types[entry_type] == "ANY":
-                i += 1
-                continue
-
-            result.append(entry_data)
-            i += entry_span
-        except Exception as e:
-            i += 1  # Skip to avoid infinite loop
+    while True:
+        # Only process Written entries, jumping straight to the next one
+        i = entry_states.find(2, i)
+        # A truncated dump may end before the page's last entries
+        if i == -1 or i >= len(headers):
+            break
+
+        entry_ns, entry_type, entry_span, chunk_index = headers[i]
+
+        decoder = nvs_entry_decoders.get(entry_type)
+        if decoder is None:
+            i += 1
+            continue
+        if entry_span < 1 or entry_span > 126 - i:
+            i += 1
+            continue
+
+        # Keys are NUL-terminated within their 16-byte field
+        key_pos = i * 32 + 8
+        key_end = entries.find(b'\x00', key_pos, key_pos + 16)
+        if key_end == -1:
+            key_end = key_pos + 16
+
+        entry_data = {
+            "key": entries[key_pos:key_end].decode('ascii', errors='ignore'),
+            "type": nvs_types[entry_type],
+            "namespace": entry_ns,  # Replaced by the name in resolve_nvs_entries
+            "span": entry_span,
+            "chunk_index": chunk_index
+        }
+
+        if decoder(entries, i, entry_span, entry_data):
+            result.append((i, entry_type, entry_data))
+        i += entry_span
 
     return result
 
-def read_nvs_pages(fh):
-    namespaces = {0: "System"}
+# Names each entry's namespace, registering namespace definitions as they appear, and stores BLOB data.
+# Pages must be passed through in order for namespaces to resolve as they would on the device.
+def resolve_nvs_entries(parsed_entries, namespaces, page_num, blob_dir=None):
     result = []
-    fh.seek(0, os.SEEK_END)
-    file_len = fh.tell()
+    for entry_index, entry_type, entry_data in parsed_entries:
+        entry_ns = entry_data["namespace"]
+        entry_data["namespace"] = namespaces.get(entry_ns, f"NS_{entry_ns}")
+        if entry_type in nvs_blob_types:
+            entry_data["value"] = store_blob_value(entry_data, blob_dir, page_num, entry_index)
+        if entry_type == 0x01 and entry_ns == 0:
+            namespaces[entry_data["value"]] = entry_data["key"]
+        result.append(entry_data)
+    return result
+
+# Yields (page_num, entries, entry_states) for every page holding entries worth decoding
+def iter_nvs_page_blocks(buf, file_len):
     sector_pos = 0
     page_num = 0
-
     while sector_pos < file_len:
-        try:
-            fh.seek(sector_pos)
-            page_state_raw = struct.unpack("<I", fh.read(4))[0]
-            page_state = nvs_sector_states.get(page_state_raw, f"Unknown (0x{page_state_raw:08x})")
-            seq_no = struct.unpack("<I", fh.read(4))[0]
-            version = (fh.read(1)[0] ^ 0xff) + 1
-
-            fh.read(19)  # unused
-            crc_32 = struct.unpack("<I", fh.read(4))[0]
-
-            if page_state not in ["ACTIVE", "FULL"]:
-                sector_pos += 4096
-                page_num += 1
-                continue
-
-            entry_state_bitmap = fh.read(32)
-            entry_state_bitmap_decoded = ''
-            for entry_num in range(126):
-                bitnum = entry_num * 2
-                byte_index = bitnum // 8
-                temp = entry_state_bitmap[byte_index]
-                temp = (temp >> (6 - (bitnum % 8))) & 3
-                entry_state_bitmap_decoded += str(temp)
-
-            entries = []
-            for i in range(126):
-                entry_data = fh.read(32)
-                if len(entry_data) != 32:
-                    break
-                entries.append(entry_data)
-
-            result.extend(parse_nvs_entries(entries, entry_state_bitmap_decoded, namespaces, page_num))
-            sector_pos += 4096
-            page_num += 1
-        except Exception as e:
-            sector_pos += 4096
-            page_num += 1
+        # Empty (erased flash) and other unreadable pages are skipped on their state word alone, and
+        # pages whose header CRC (over seq_no, version and the unused bytes) does not match are not trusted
+        page_header = buf[sector_pos:sector_pos + 32]
+        if (int.from_bytes(page_header[:4], 'little') in nvs_readable_states
+                and zlib.crc32(page_header[4:28], 0xFFFFFFFF) == int.from_bytes(page_header[28:], 'little')):
+            entry_state_bitmap = buf[sector_pos + 32:sector_pos + 64]
+            entry_states = b''.join([entry_state_table[byte] for byte in entry_state_bitmap])[:126]
+
+            # Drop any trailing partial entry of a truncated dump
+            entries_end = min(sector_pos + 4096, file_len)
+            entries = buf[sector_pos + 64:entries_end - (entries_end - sector_pos - 64) % 32]
+
+            yield page_num, entries, entry_states
+        sector_pos += 4096
+        page_num += 1
+
+# Runs in worker processes when decoding in parallel, so it takes and returns picklable values only
+def decode_nvs_page(page_block):
+    page_num, entries, entry_states = page_block
+    try:
+        return page_num, parse_nvs_entries(entries, entry_states)
+    except Exception as e:
+        return page_num, []  # Skip a page that cannot be decoded rather than abort the dump
+
+# Decodes pages in worker processes, yielding results in page order. Only a few pages per worker
+# are in flight at once, so memory stays bounded however large the dump is.
+def decode_nvs_pages_parallel(page_blocks, jobs):
+    with ProcessPoolExecutor(jobs) as executor:
+        pending = deque()
+        for page_block in page_blocks:
+            pending.append(executor.submit(decode_nvs_page, page_block))
+            if len(pending) >= jobs * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+# Yields the entries of each page in turn, adding namespaces to the given map as they are found.
+# With jobs > 1 pages are decoded in that many worker processes and resolved here in page order.
+def iter_nvs_entries(fh, namespaces, blob_dir=None, jobs=1):
+    fh.seek(0, os.SEEK_END)
+    file_len = fh.tell()
+    if file_len == 0:
+        return
 
+    with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        page_blocks = iter_nvs_page_blocks(buf, file_len)
+        if jobs > 1:
+            decoded_pages = decode_nvs_pages_parallel(page_blocks, jobs)
+        else:
+            decoded_pages = map(decode_nvs_page, page_blocks)
+        for page_num, parsed_entries in decoded_pages:
+            yield from resolve_nvs_entries(parsed_entries, namespaces, page_num, blob_dir)
+
+def read_nvs_pages(fh, blob_dir=None, jobs=1):
+    namespaces = {0: "System"}
+    result = list(iter_nvs_entries(fh, namespaces, blob_dir, jobs))
     return result, namespaces
 
+if orjson is not None:
+    def dump_json(obj, pretty=False):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if pretty else 0))
+else:
+    def dump_json(obj, pretty=False):
+        if pretty:
+            return json.dumps(obj, indent=2).encode()
+        return json.dumps(obj, separators=(',', ':')).encode()
+
+# Entries are written as they are decoded, so the full list is never held in memory.
+# The namespace map is only complete once every entry has been seen and therefore comes last.
+# Pretty output indents each value on its own and shifts its lines to the value's depth.
+def write_nvs_json(f, entries, namespaces, pretty=False):
+    if pretty:
+        head, separator, middle, tail = b'{\n  "entries": [\n    ', b',\n    ', b'\n  ],\n  "namespaces": ', b'\n}\n'
+    else:
+        head, separator, middle, tail = b'{"entries":[', b',', b'],"namespaces":', b'}\n'
+    f.write(head)
+    for n, entry in enumerate(entries):
+        if n:
+            f.write(separator)
+        f.write(dump_json(entry, pretty).replace(b'\n', b'\n    ') if pretty else dump_json(entry))
+    f.write(middle)
+    f.write(dump_json(namespaces, pretty).replace(b'\n', b'\n  '))
+    f.write(tail)
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
 def main():
     parser = argparse.ArgumentParser(description="Read ESP32 NVS partition and output to JSON")
     parser.add_argument("nvs_bin_file", help="NVS partition binary file")
     parser.add_argument("output_json", help="Output JSON file")
+    parser.add_argument("--blob-dir", help="Write BLOB data to files in this directory instead of inlining it as hex")
+    parser.add_argument("--pretty", action="store_true", help="Indent the JSON output for reading (slower for large dumps)")
+    parser.add_argument("--jobs", type=positive_int, default=1, help="Decode pages in this many worker processes (default: 1)")
     args = parser.parse_args()
 
     try:
         with open(args.nvs_bin_file, 'rb') as fh:
-            data, namespaces = read_nvs_pages(fh)
-            output = {
-                "namespaces": namespaces,
-                "entries": data
-            }
-            with open(args.output_json, 'w') as f:
-                json.dump(output, f, indent=2)
+            if args.blob_dir:
+                os.makedirs(args.blob_dir, exist_ok=True)
+            namespaces = {0: "System"}
+            with open(args.output_json, 'wb') as f:
+                write_nvs_json(f, iter_nvs_entries(fh, namespaces, args.blob_dir, args.jobs), namespaces, args.pretty)
         print(f"Successfully wrote NVS data to {args.output_json}")
     except FileNotFoundError as e:
         print(f"Error: File not found: {e}")